@@ -1,18 +1,40 @@
 import numpy as np
-import pandas as pd
-import random
 import os
 from math import ceil
-from sklearn.model_selection import train_test_split
+from functools import lru_cache
 from sklearn.preprocessing import MinMaxScaler
 from itertools import combinations
 from sklearn.mixture import GaussianMixture
+from joblib import Parallel, delayed
+from scipy.stats import gaussian_kde
+from scipy.special import ndtr
 
-from copulas.multivariate import VineCopula
-from copulas.univariate import GaussianKDE
+import pyvinecopulib as pv
 
 from myutils import Utils
 
+# the raw dataset is cached, since the benchmark pipeline calls the generator repeatedly on the same dataset
+# (e.g., for different seeds and ratios of labeled anomalies), and only the current dataset is kept since
+# the datasets are iterated in the outermost loop of the pipeline
+@lru_cache(maxsize=1)
+def load_dataset(folder:str, dataset:str):
+    return load_npz(folder, dataset)
+
+# the generated dependency anomalies are cached separately (so that they do not evict the raw dataset),
+# where each seed is saved in its own file and the (three) seeds are iterated in the innermost loop of the pipeline
+@lru_cache(maxsize=3)
+def load_dependency_anomalies(filepath:str):
+    return load_npz('synthetic', filepath)
+
+def load_npz(folder:str, dataset:str):
+    data = np.load(os.path.join('datasets', folder, dataset + '.npz'), allow_pickle=True)
+    X = data['X']; y = data['y']
+
+    # the cached arrays are shared by all the calls, so they should never be modified in place
+    X.setflags(write=False); y.setflags(write=False)
+
+    return X, y
+
 # currently, data generator only supports for generating the binary classification datasets
 class DataGenerator():
     def __init__(self, seed:int=42, dataset:str=None, test_size:float=0.3,
@@ -32,6 +54,9 @@ class DataGenerator():
         self.generate_duplicates = generate_duplicates
         self.n_samples_threshold = n_samples_threshold
 
+        # random generator used for all the sampling operations (reset in each call of the generator function)
+        self.rng = np.random.default_rng(self.seed)
+
         # dataset list
         self.dataset_list_classical = [os.path.splitext(_)[0] for _ in os.listdir('datasets/Classical')
                                        if os.path.splitext(_)[1] == '.npz'] # classical AD datasets
@@ -43,7 +68,34 @@ class DataGenerator():
         # myutils function
         self.utils = Utils()
 
-    def generate_realistic_synthetic(self, X, y, realistic_synthetic_mode, alpha:int, percentage:float):
+    def fit_gm_list(self, X, n_components_list):
+        # the GMMs are fitted in parallel, except for small datasets where the overhead of workers dominates
+        n_jobs = -1 if X.shape[0] * X.shape[1] > 100000 else 1
+        gm_list = Parallel(n_jobs=n_jobs)(delayed(GaussianMixture(n_components=n_components, random_state=self.seed).fit)(X)
+                                          for n_components in n_components_list)
+
+        return gm_list
+
+    def sample_gm(self, weights, means, covariances, n_samples):
+        # sampling from the GMM with the modified parameters, where the (full) covariances are only decomposed once
+        n_samples_comp = self.rng.multinomial(n_samples, weights)
+        chols = np.linalg.cholesky(np.asarray(covariances, dtype=np.float64))
+
+        X = np.concatenate([mean + self.rng.standard_normal((n, len(mean))) @ chol.T
+                            for mean, chol, n in zip(np.asarray(means, dtype=np.float64), chols, n_samples_comp)], axis=0)
+
+        return X
+
+    def kde_quantile(self, x, u, n_grid:int=512):
+        # the quantile function (inverse CDF) of the GaussianKDE fitted on x, interpolated on a grid of the KDE support
+        kde = gaussian_kde(x)
+        bandwidth = np.sqrt(kde.covariance[0, 0])
+        grid = np.linspace(x.min() - 5 * bandwidth, x.max() + 5 * bandwidth, n_grid)
+        cdf = np.mean(ndtr((grid[:, None] - x[None, :]) / bandwidth), axis=1)
+
+        return np.interp(u, cdf, grid)
+
+    def generate_realistic_synthetic(self, X, y, realistic_synthetic_mode, alpha:int, percentage:float, n_components:int=None):
         '''
         Currently, four types of realistic synthetic outliers can be generated:
         1. local outliers: where normal data follows the GMM distribuion, and anomalies follow the GMM distribution with modified covariance
@@ -56,6 +108,7 @@ class DataGenerator():
         :param realistic_synthetic_mode: the type of generated outliers
         :param alpha: the scaling parameter for controling the generated local and cluster anomalies
         :param percentage: controling the generated global anomalies
+        :param n_components: the number of GMM components, which is selected from 1 to 9 based on the BIC value if None
         '''
 
         if realistic_synthetic_mode in ['local', 'cluster', 'dependency', 'global']:
@@ -64,43 +117,59 @@ class DataGenerator():
             raise NotImplementedError
 
         # the number of normal data and anomalies
-        pts_n = len(np.where(y == 0)[0])
-        pts_a = len(np.where(y == 1)[0])
+        mask_n = (y == 0)
+        pts_n = int(mask_n.sum())
+        pts_a = len(y) - pts_n
 
         # only use the normal data to fit the model
-        X = X[y == 0]
-        y = y[y == 0]
+        X = X[mask_n]
+        y = y[mask_n]
 
         # generate the synthetic normal data
         if realistic_synthetic_mode in ['local', 'cluster', 'global']:
-            # select the best n_components based on the BIC value
-            metric_list = []
-            n_components_list = list(np.arange(1, 10))
+            # select the best n_components based on the BIC value, unless it is specified
+            # (the fitted models are kept, so that the best one can be reused without refitting)
+            n_components_list = list(np.arange(1, 10)) if n_components is None else [n_components]
 
-            for n_components in n_components_list:
-                gm = GaussianMixture(n_components=n_components, random_state=self.seed).fit(X)
-                metric_list.append(gm.bic(X))
+            # the GMMs are fitted on float32 data for efficiency, which however may fail on the ill-conditioned dataset
+            try:
+                X_fit = np.ascontiguousarray(X, dtype=np.float32)
+                gm_list = self.fit_gm_list(X_fit, n_components_list)
+            except ValueError:
+                X_fit = X
+                gm_list = self.fit_gm_list(X_fit, n_components_list)
 
-            best_n_components = n_components_list[np.argmin(metric_list)]
+            metric_list = [gm.bic(X_fit) for gm in gm_list]
 
-            # refit based on the best n_components
-            gm = GaussianMixture(n_components=best_n_components, random_state=self.seed).fit(X)
+            gm = gm_list[np.argmin(metric_list)]
 
             # generate the synthetic normal data
             X_synthetic_normal = gm.sample(pts_n)[0]
 
         # we found that copula function may occur error in some datasets
         elif realistic_synthetic_mode == 'dependency':
-            # sampling the feature since copulas method may spend too long to fit
-            if X.shape[1] > 50:
-                idx = np.random.choice(np.arange(X.shape[1]), 50, replace=False)
-                X = X[:, idx]
+            # the dependence is undefined for constant features, which are therefore excluded from the copula and repeated directly
+            idx_nonconstant = np.flatnonzero(np.ptp(X, axis=0) > 0)
+            X_synthetic_normal = np.repeat(X[:1].astype(float), pts_n, axis=0)
+
+            # fit the vine copula on the pseudo-observations (i.e., the empirical probability integral transform)
+            # ties are broken randomly, since the pair copulas of heavily tied (e.g., sparse binary) features are degenerated
+            u = pv.to_pseudo_obs(X[:, idx_nonconstant], ties_method='random', seeds=[self.seed])
+            controls = pv.FitControlsVinecop(family_set=[pv.BicopFamily.indep, pv.BicopFamily.gaussian,
+                                                         pv.BicopFamily.clayton, pv.BicopFamily.frank],
+                                             parametric_method='itau')
+
+            # instead of sampling the features, the vine is truncated for the high-dimensional data to keep the fitting tractable
+            if len(idx_nonconstant) > 50:
+                controls.trunc_lvl = 5
 
-            copula = VineCopula('center') # default is the C-vine copula
-            copula.fit(pd.DataFrame(X))
+            copula = pv.Vinecop.from_data(u, controls=controls)
 
-            # sample to generate synthetic normal data
-            X_synthetic_normal = copula.sample(pts_n).values
+            # sample to generate synthetic normal data, which is mapped back by the quantile function of each feature's GaussianKDE
+            # (i.e., the same marginal distributions as the dependency anomalies, which only differ in the dependence structure)
+            u_synthetic = copula.sample(pts_n, seeds=[self.seed])
+            for j, i in enumerate(idx_nonconstant):
+                X_synthetic_normal[:, i] = self.kde_quantile(X[:, i].astype(float), u_synthetic[:, j])
 
         else:
             pass
@@ -108,41 +177,35 @@ class DataGenerator():
         # generate the synthetic abnormal data
         if realistic_synthetic_mode == 'local':
             # generate the synthetic anomalies (local outliers)
-            gm.covariances_ = alpha * gm.covariances_
-            X_synthetic_anomalies = gm.sample(pts_a)[0]
+            X_synthetic_anomalies = self.sample_gm(gm.weights_, gm.means_, alpha * gm.covariances_, pts_a)
 
         elif realistic_synthetic_mode == 'cluster':
             # generate the clustering synthetic anomalies
-            gm.means_ = alpha * gm.means_
-            X_synthetic_anomalies = gm.sample(pts_a)[0]
+            X_synthetic_anomalies = self.sample_gm(gm.weights_, alpha * gm.means_, gm.covariances_, pts_a)
 
         elif realistic_synthetic_mode == 'dependency':
-            X_synthetic_anomalies = np.zeros((pts_a, X.shape[1]))
-
             # using the GuassianKDE for generating independent feature
+            # (the KDE is undefined for constant features, which are therefore repeated directly)
+            X_synthetic_anomalies = np.empty((pts_a, X.shape[1]))
             for i in range(X.shape[1]):
-                kde = GaussianKDE()
-                kde.fit(X[:, i])
-                X_synthetic_anomalies[:, i] = kde.sample(pts_a)
+                if np.ptp(X[:, i]) > 0:
+                    X_synthetic_anomalies[:, i] = gaussian_kde(X[:, i]).resample(pts_a, seed=self.rng)[0]
+                else:
+                    X_synthetic_anomalies[:, i] = X[0, i]
 
         elif realistic_synthetic_mode == 'global':
             # generate the synthetic anomalies (global outliers)
-            X_synthetic_anomalies = []
-
-            for i in range(X_synthetic_normal.shape[1]):
-                low = np.min(X_synthetic_normal[:, i]) * (1 + percentage)
-                high = np.max(X_synthetic_normal[:, i]) * (1 + percentage)
-
-                X_synthetic_anomalies.append(np.random.uniform(low=low, high=high, size=pts_a))
+            low = np.min(X_synthetic_normal, axis=0) * (1 + percentage)
+            high = np.max(X_synthetic_normal, axis=0) * (1 + percentage)
 
-            X_synthetic_anomalies = np.array(X_synthetic_anomalies).T
+            X_synthetic_anomalies = self.rng.uniform(low=low, high=high, size=(pts_a, X_synthetic_normal.shape[1]))
 
         else:
             pass
 
         X = np.concatenate((X_synthetic_normal, X_synthetic_anomalies), axis=0)
-        y = np.append(np.repeat(0, X_synthetic_normal.shape[0]),
-                      np.repeat(1, X_synthetic_anomalies.shape[0]))
+        y = np.zeros(X.shape[0], dtype=int)
+        y[X_synthetic_normal.shape[0]:] = 1
 
         return X, y
 
@@ -158,13 +221,14 @@ class DataGenerator():
             pass
         else:
             # index of normal and anomaly data
-            idx_n = np.where(y==0)[0]
-            idx_a = np.where(y==1)[0]
+            mask_n = (y == 0)
+            idx_n = np.flatnonzero(mask_n)
+            idx_a = np.flatnonzero(~mask_n)
 
             # generate duplicated anomalies
-            idx_a = np.random.choice(idx_a, int(len(idx_a) * duplicate_times))
+            idx_a = self.rng.choice(idx_a, int(len(idx_a) * duplicate_times))
 
-            idx = np.append(idx_n, idx_a); random.shuffle(idx)
+            idx = np.concatenate((idx_n, idx_a)); self.rng.shuffle(idx)
             X = X[idx]; y = y[idx]
 
         return X, y
@@ -176,19 +240,17 @@ class DataGenerator():
         else:
             noise_dim = int(noise_ratio / (1 - noise_ratio) * X.shape[1])
             if noise_dim > 0:
-                X_noise = []
-                for i in range(noise_dim):
-                    idx = np.random.choice(np.arange(X.shape[1]), 1)
-                    X_min = np.min(X[:, idx])
-                    X_max = np.max(X[:, idx])
+                # each noise feature is uniformly distributed within the range of a randomly selected feature
+                idx = self.rng.choice(X.shape[1], noise_dim)
+                X_min = np.min(X, axis=0)[idx]
+                X_max = np.max(X, axis=0)[idx]
 
-                    X_noise.append(np.random.uniform(X_min, X_max, size=(X.shape[0], 1)))
+                X_noise = self.rng.uniform(X_min, X_max, size=(X.shape[0], noise_dim))
 
                 # concat the irrelevant noise feature
-                X_noise = np.hstack(X_noise)
                 X = np.concatenate((X, X_noise), axis=1)
                 # shuffle the dimension
-                idx = np.random.choice(np.arange(X.shape[1]), X.shape[1], replace=False)
+                idx = self.rng.permutation(X.shape[1])
                 X = X[:, idx]
 
         return X, y
@@ -198,39 +260,46 @@ class DataGenerator():
             pass
         else:
             # here we consider the label flips situation: a label is randomly filpped to another class with probability p (i.e., noise ratio)
-            idx_flips = np.random.choice(np.arange(len(y)), int(len(y) * noise_ratio), replace=False)
-            y[idx_flips] = 1 - y[idx_flips] # change 0 to 1 and 1 to 0
+            idx_flips = self.rng.choice(len(y), int(len(y) * noise_ratio), replace=False)
+
+            # the binary labels are flipped in place by XOR (i.e., change 0 to 1 and 1 to 0),
+            # while the non-integer labels (e.g., of the customized dataset) keep their dtype
+            if np.issubdtype(y.dtype, np.integer):
+                y[idx_flips] ^= 1
+            else:
+                y[idx_flips] = 1 - y[idx_flips]
 
         return X, y
 
     def generator(self, X=None, y=None, minmax=True,
                   la=None, at_least_one_labeled=False,
-                  realistic_synthetic_mode=None, alpha:int=5, percentage:float=0.1,
-                  noise_type=None, duplicate_times:int=2, contam_ratio=1.00, noise_ratio:float=0.05):
+                  realistic_synthetic_mode=None, alpha:int=5, percentage:float=0.1, n_components:int=None,
+                  noise_type=None, duplicate_times:int=2, contam_ratio=1.00, noise_ratio:float=0.05,
+                  dtype=np.float32):
         '''
         la: labeled anomalies, can be either the ratio of labeled anomalies or the number of labeled anomalies
         at_least_one_labeled: whether to guarantee at least one labeled anomalies in the training set
+        n_components: the number of GMM components for the local, global and cluster anomalies (selected by the BIC value if None)
+        dtype: the dtype of the returned features (float32 by default for saving memory, None for keeping the original dtype)
         '''
 
         # set seed for reproducible results
         self.utils.set_seed(self.seed)
+        self.rng = np.random.default_rng(self.seed)
 
         # load dataset
         if self.dataset is None:
             assert X is not None and y is not None, "For customized dataset, you should provide the X and y!"
         else:
             if self.dataset in self.dataset_list_classical:
-                data = np.load(os.path.join('datasets', 'Classical', self.dataset + '.npz'), allow_pickle=True)
+                X, y = load_dataset('Classical', self.dataset)
             elif self.dataset in self.dataset_list_cv:
-                data = np.load(os.path.join('datasets', 'CV_by_ResNet18', self.dataset + '.npz'), allow_pickle=True)
+                X, y = load_dataset('CV_by_ResNet18', self.dataset)
             elif self.dataset in self.dataset_list_nlp:
-                data = np.load(os.path.join('datasets', 'NLP_by_BERT', self.dataset + '.npz'), allow_pickle=True)
+                X, y = load_dataset('NLP_by_BERT', self.dataset)
             else:
                 raise NotImplementedError
 
-            X = data['X']
-            y = data['y']
-
         # number of labeled anomalies in the original data
         if type(la) == float:
             if at_least_one_labeled:
@@ -245,16 +314,14 @@ class DataGenerator():
         # if the dataset is too small, generating duplicate smaples up to n_samples_threshold
         if len(y) < self.n_samples_threshold and self.generate_duplicates:
             print(f'generating duplicate samples for dataset {self.dataset}...')
-            self.utils.set_seed(self.seed)
-            idx_duplicate = np.random.choice(np.arange(len(y)), self.n_samples_threshold, replace=True)
+            idx_duplicate = self.rng.choice(np.arange(len(y)), self.n_samples_threshold, replace=True)
             X = X[idx_duplicate]
             y = y[idx_duplicate]
 
         # if the dataset is too large, subsampling for considering the computational cost
         if len(y) > 10000:
             print(f'subsampling for dataset {self.dataset}...')
-            self.utils.set_seed(self.seed)
-            idx_sample = np.random.choice(np.arange(len(y)), 10000, replace=False)
+            idx_sample = self.rng.choice(np.arange(len(y)), 10000, replace=False)
             X = X[idx_sample]
             y = y[idx_sample]
 
@@ -265,24 +332,22 @@ class DataGenerator():
                 if not os.path.exists('datasets/synthetic'):
                     os.makedirs('datasets/synthetic')
 
-                filepath = 'dependency_anomalies_' + self.dataset + '_' + str(self.seed) + '.npz'
-                try:
-                    data_dependency = np.load(os.path.join('datasets', 'synthetic', filepath), allow_pickle=True)
-                    X = data_dependency['X']; y = data_dependency['y']
+                # each dataset and seed is saved in its own file, so that only the required data is loaded (and cached)
+                filepath = 'dependency_anomalies_' + self.dataset + '_' + str(self.seed)
+                if os.path.exists(os.path.join('datasets', 'synthetic', filepath + '.npz')):
+                    X, y = load_dependency_anomalies(filepath)
 
-                except:
-                    # raise NotImplementedError
+                else:
                     print(f'Generating dependency anomalies...')
                     X, y = self.generate_realistic_synthetic(X, y,
                                                              realistic_synthetic_mode=realistic_synthetic_mode,
                                                              alpha=alpha, percentage=percentage)
-                    np.savez_compressed(os.path.join('datasets', 'synthetic', filepath), X=X, y=y)
-                    pass
+                    np.savez_compressed(os.path.join('datasets', 'synthetic', filepath + '.npz'), X=X, y=y)
 
             else:
                 X, y = self.generate_realistic_synthetic(X, y,
                                                          realistic_synthetic_mode=realistic_synthetic_mode,
-                                                         alpha=alpha, percentage=percentage)
+                                                         alpha=alpha, percentage=percentage, n_components=n_components)
 
         # whether to add different types of noise for testing the robustness of benchmark models
         if noise_type is None:
@@ -306,8 +371,16 @@ class DataGenerator():
         # show the statistic
         self.utils.data_description(X=X, y=y)
 
-        # spliting the current data to the training set and testing set
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=self.test_size, shuffle=True, stratify=y)
+        # spliting the current data to the training set and testing set (stratified by the binary label)
+        mask_n = (y == 0)
+        idx_n = self.rng.permutation(np.flatnonzero(mask_n))
+        idx_a = self.rng.permutation(np.flatnonzero(~mask_n))
+        n_test_n = int(round(len(idx_n) * self.test_size))
+        n_test_a = int(round(len(idx_a) * self.test_size))
+
+        idx_train = np.concatenate((idx_n[n_test_n:], idx_a[n_test_a:])); self.rng.shuffle(idx_train)
+        idx_test = np.concatenate((idx_n[:n_test_n], idx_a[:n_test_a])); self.rng.shuffle(idx_test)
+        X_train, X_test, y_train, y_test = X[idx_train], X[idx_test], y[idx_train], y[idx_test]
 
         # we respectively generate the duplicated anomalies for the training and testing set
         if noise_type == 'duplicated_anomalies':
@@ -320,9 +393,18 @@ class DataGenerator():
 
         # minmax scaling
         if minmax:
-            scaler = MinMaxScaler().fit(X_train)
-            X_train = scaler.transform(X_train)
-            X_test = scaler.transform(X_test)
+            scaler = MinMaxScaler()
+            X_train = scaler.fit_transform(X_train)
+
+            # the testing set is a copy after splitting, so it can be transformed in place (i.e., X * scale_ + min_)
+            X_test = np.asarray(X_test, dtype=X_train.dtype)
+            X_test *= scaler.scale_
+            X_test += scaler.min_
+
+        # the features (rather than the labels) are casted to the required dtype
+        if dtype is not None:
+            X_train = X_train.astype(dtype, copy=False)
+            X_test = X_test.astype(dtype, copy=False)
 
         # idx of normal samples and unlabeled/labeled anomalies
         idx_normal = np.where(y_train == 0)[0]
@@ -330,24 +412,27 @@ class DataGenerator():
 
         if type(la) == float:
             if at_least_one_labeled:
-                idx_labeled_anomaly = np.random.choice(idx_anomaly, ceil(la * len(idx_anomaly)), replace=False)
+                idx_labeled_anomaly = self.rng.choice(idx_anomaly, ceil(la * len(idx_anomaly)), replace=False)
             else:
-                idx_labeled_anomaly = np.random.choice(idx_anomaly, int(la * len(idx_anomaly)), replace=False)
+                idx_labeled_anomaly = self.rng.choice(idx_anomaly, int(la * len(idx_anomaly)), replace=False)
         elif type(la) == int:
             if la > len(idx_anomaly):
                 raise AssertionError(f'the number of labeled anomalies are greater than the total anomalies: {len(idx_anomaly)} !')
             else:
-                idx_labeled_anomaly = np.random.choice(idx_anomaly, la, replace=False)
+                idx_labeled_anomaly = self.rng.choice(idx_anomaly, la, replace=False)
         else:
             raise NotImplementedError
 
-        idx_unlabeled_anomaly = np.setdiff1d(idx_anomaly, idx_labeled_anomaly)
+        # the labeled anomalies are a subset of all anomalies, therefore a mask is enough to find the unlabeled ones
+        mask_labeled = np.zeros(len(y_train), dtype=bool)
+        mask_labeled[idx_labeled_anomaly] = True
+        idx_unlabeled_anomaly = idx_anomaly[~mask_labeled[idx_anomaly]]
         # whether to remove the anomaly contamination in the unlabeled data
         if noise_type == 'anomaly_contamination':
             idx_unlabeled_anomaly = self.remove_anomaly_contamination(idx_unlabeled_anomaly, contam_ratio)
 
         # unlabel data = normal data + unlabeled anomalies (which is considered as contamination)
-        idx_unlabeled = np.append(idx_normal, idx_unlabeled_anomaly)
+        idx_unlabeled = np.concatenate((idx_normal, idx_unlabeled_anomaly))
 
         del idx_anomaly, idx_unlabeled_anomaly
 